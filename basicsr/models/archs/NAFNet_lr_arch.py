@@ -13,12 +13,14 @@ Simple Baselines for Image Restoration
 }
 '''
 
+import copy
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from basicsr.models.archs.arch_util import LayerNorm2d
 from basicsr.models.archs.local_arch import Local_Base
-from torchsummary import summary
 import torch.nn.utils.parametrize as parametrize
 from torch.nn.functional import softplus
 
@@ -27,6 +29,14 @@ class _LipNorm(nn.Module):
     def __init__(self, weight: torch.Tensor):
         super().__init__()
         self.ci = nn.Parameter(torch.tensor(1.), requires_grad=True)
+        # the scaled weight is reused across forward passes at inference,
+        # until the underlying weight or ci is modified (optimizer step,
+        # load_state_dict, .to(), ...) or the module goes back to training
+        self.register_buffer('_cached_weight', None, persistent=False)
+        self._cache_key = None
+        # same for softplus(ci), which is shared by every weight recompute
+        self._cached_softplus = None
+        self._softplus_key = None
 
     def _reshape_weight_to_matrix(self, weight: torch.Tensor) -> torch.Tensor:
         # Precondition
@@ -38,15 +48,47 @@ class _LipNorm(nn.Module):
 
         return weight.flatten(1)
     
+    def _weight_key(self, weight: torch.Tensor):
+        return (weight.data_ptr(), weight._version, self.ci.data_ptr(), self.ci._version)
+
+    def train(self, mode: bool = True):
+        # switching to eval keeps the caches, they are keyed on the weight versions
+        if mode:
+            self._cached_weight = None
+            self._cache_key = None
+            self._cached_softplus = None
+            self._softplus_key = None
+        return super().train(mode)
+
+    def _softplus_ci(self):
+        if self.training or torch.is_grad_enabled():
+            return softplus(self.ci)
+
+        key = (self.ci.data_ptr(), self.ci._version)
+        if self._cached_softplus is None or self._softplus_key != key:
+            self._cached_softplus = softplus(self.ci).detach()
+            self._softplus_key = key
+        return self._cached_softplus
+
     def forward(self, weight: torch.Tensor):
+        if self.training or torch.is_grad_enabled():
+            return self._normalize(weight)
+
+        key = self._weight_key(weight)
+        if self._cached_weight is None or self._cache_key != key:
+            self._cached_weight = self._normalize(weight)
+            self._cache_key = key
+        return self._cached_weight
+
+    def _normalize(self, weight: torch.Tensor):
 #         assert weight.ndim == 2
         weight_mat = self._reshape_weight_to_matrix(weight)
         
-        softplus_ci = softplus(self.ci)
+        softplus_ci = self._softplus_ci()
         absrowsum = torch.sum(torch.abs(weight_mat), dim=1)
-        scale = torch.min(torch.tensor(1.0), softplus_ci / absrowsum)
+        scale = (softplus_ci / absrowsum).clamp(max=1.0)
 
-        return weight * scale[:,None,None,None]
+        return weight * scale.view(-1, 1, 1, 1)
         
     def right_inverse(self, value: torch.Tensor) -> torch.Tensor:
         # we may want to assert here that the passed value already
@@ -64,17 +106,64 @@ def LipNorm(module: nn.Module,name: str = 'weight') -> nn.Module:
     parametrize.register_parametrization(module, name, _LipNorm(weight))
     return module
 
+def circular_pad(x, pwd, pht):
+    # same result as F.pad(x, (pwd, pwd, pht, pht), 'circular') for 0 <= pad <= size,
+    # but torch.cat keeps channels_last inputs in channels_last, while F.pad's
+    # circular mode always returns a contiguous NCHW tensor
+    if pwd > 0:
+        x = torch.cat([x[..., -pwd:], x, x[..., :pwd]], dim=-1)
+    if pht > 0:
+        x = torch.cat([x[..., -pht:, :], x, x[..., :pht, :]], dim=-2)
+    return x
+
+class CircularConv2d(nn.Conv2d):
+    """Conv2d with padding_mode='circular' padded through circular_pad."""
+
+    def __init__(self, *args, **kwargs):
+        padding_mode = kwargs.pop('padding_mode', 'circular')
+        if padding_mode != 'circular':
+            raise ValueError(
+                "CircularConv2d only supports padding_mode='circular', got '{}'".format(padding_mode)
+            )
+        super().__init__(*args, padding_mode='circular', **kwargs)
+
+        if not (isinstance(self.padding, tuple) and all(isinstance(p, int) and p > 0 for p in self.padding)):
+            raise ValueError(
+                "CircularConv2d needs a positive integer padding, got {}".format(self.padding)
+            )
+
+    def _conv_forward(self, input, weight, bias):
+        pht, pwd = self.padding
+        return F.conv2d(circular_pad(input, pwd, pht), weight, bias, self.stride, 0, self.dilation, self.groups)
+
+@torch.jit.script
+def scale_conv1x1(x, scale, weight, bias: Optional[torch.Tensor]):
+    # channel attention multiply feeding straight into a 1x1 conv
+    return F.conv2d(x * scale, weight, bias)
+
+@torch.jit.script
+def layer_norm_conv1x1(x, gamma, beta, eps: float, weight, bias: Optional[torch.Tensor]):
+    # LayerNorm2d over channels followed by a 1x1 conv, scripted as one graph
+    mu = x.mean(1, keepdim=True)
+    var = x.var(1, keepdim=True, unbiased=False)
+    y = (x - mu) * torch.rsqrt(var + eps) * gamma.view(1, -1, 1, 1) + beta.view(1, -1, 1, 1)
+    return F.conv2d(y, weight, bias)
+
+def _autocast_enabled():
+    # eager autocast does not reach inside the scripted helpers above
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
 class SimpleGate(nn.Module):
     def forward(self, x):
-        x1, x2 = x.chunk(2, dim=1)
-        return x1 * x2
+        c = x.shape[1] // 2
+        return torch.mul(x.narrow(1, 0, c), x.narrow(1, c, c))
 
 class NAFBlock(nn.Module):
     def __init__(self, c, DW_Expand=2, FFN_Expand=2, drop_out_rate=0.):
         super().__init__()
         dw_channel = c * DW_Expand
         self.conv1 = LipNorm(nn.Conv2d(in_channels=c, out_channels=dw_channel, kernel_size=1, padding=0, stride=1, groups=1, bias=True))
-        self.conv2 = LipNorm(nn.Conv2d(in_channels=dw_channel, out_channels=dw_channel, kernel_size=3, padding=0, stride=1, groups=dw_channel,
+        self.conv2 = LipNorm(CircularConv2d(in_channels=dw_channel, out_channels=dw_channel, kernel_size=3, padding=1, stride=1, groups=dw_channel,
                                bias=True))
         self.conv3 = LipNorm(nn.Conv2d(in_channels=dw_channel // 2, out_channels=c, kernel_size=1, padding=0, stride=1, groups=1, bias=True))
         
@@ -98,61 +187,62 @@ class NAFBlock(nn.Module):
         self.dropout1 = nn.Dropout(drop_out_rate) if drop_out_rate > 0. else nn.Identity()
         self.dropout2 = nn.Dropout(drop_out_rate) if drop_out_rate > 0. else nn.Identity()
 
-        self.beta = nn.Parameter(torch.zeros((1, c, 1, 1)), requires_grad=True)
-        self.gamma = nn.Parameter(torch.zeros((1, c, 1, 1)), requires_grad=True)
+        self.beta = nn.Parameter(torch.zeros(c), requires_grad=True)
+        self.gamma = nn.Parameter(torch.zeros(c), requires_grad=True)
 
     def forward(self, inp):
         x = inp
+        scripted = not _autocast_enabled()
 
-        x = self.norm1(x)
-
-        x = self.conv1(x)
-        x = self.CircularPadding(x)
+        if scripted:
+            x = layer_norm_conv1x1(x, self.norm1.weight, self.norm1.bias, self.norm1.eps,
+                                   self.conv1.weight, self.conv1.bias)
+        else:
+            x = self.conv1(self.norm1(x))
         x = self.conv2(x)
         x = self.sg(x)
-        x = x * self.sca(x)
-        x = self.conv3(x)
+        pool, sca_conv = self.sca
+        s = F.conv2d(pool(x), sca_conv.weight, sca_conv.bias)
+        if scripted:
+            x = scale_conv1x1(x, s, self.conv3.weight, self.conv3.bias)
+        else:
+            x = self.conv3(x * s)
 
         x = self.dropout1(x)
 
-        y = inp + x * self.beta
+        y = torch.addcmul(inp, x, self.beta.view(1, -1, 1, 1))
 
-        x = self.conv4(self.norm2(y))
+        if scripted:
+            x = layer_norm_conv1x1(y, self.norm2.weight, self.norm2.bias, self.norm2.eps,
+                                   self.conv4.weight, self.conv4.bias)
+        else:
+            x = self.conv4(self.norm2(y))
         # x = self.conv4(y) # if no layer normalization 
         x = self.sg(x)
         x = self.conv5(x)
 
         x = self.dropout2(x)
 
-        return y + x * self.gamma
-
-    def CircularPadding(self, inp):
-        _, _, H, W = inp.shape
-        kht, kwd = [3, 3]
-        sht, swd = [1, 1]
-        assert kwd%2 != 0 and kht%2 !=0 and (W-kwd)%swd==0 and (H-kht)%sht ==0, 'kernel_size should be odd, (dim-kernel_size) should be divisible by stride'
+        return torch.addcmul(y, x, self.gamma.view(1, -1, 1, 1))
 
-        pwd = int((W - 1 - (W - kwd) / swd) // 2)
-        pht = int((H - 1 - (H - kht) / sht) // 2)
-        
-        # kht1, kwd1 = self.kernel_sizes[1]
-        # kht2, kwd2 = self.kernel_sizes[2]
-        # pwd = int((W - 1 - (W - kwd) / swd) // 2 + (W - 1 - (W - kwd1) / swd) // 2 + (W - 1 - (W - kwd2) / swd) // 2)
-        # pht = int((H - 1 - (H - kht) / sht) // 2 + (H - 1 - (H - kht1) / sht) // 2 + (H - 1 - (H - kht2) / sht) // 2)
-        
-        x = F.pad(inp, (pwd, pwd, pht, pht), 'circular')
-
-        return x
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store beta / gamma with shape (1, c, 1, 1)
+        for name in ('beta', 'gamma'):
+            key = prefix + name
+            if key in state_dict and state_dict[key].dim() == 4:
+                state_dict[key] = state_dict[key].flatten()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class NAFNet_lr(nn.Module):
 
-    def __init__(self, img_channel=3, width=16, middle_blk_num=1, enc_blk_nums=[], dec_blk_nums=[]):
+    def __init__(self, img_channel=3, width=16, middle_blk_num=1, enc_blk_nums=[], dec_blk_nums=[], channels_last=True,
+                 amp_dtype=None):
         super().__init__()
 
-        self.intro = LipNorm(nn.Conv2d(in_channels=img_channel, out_channels=width, kernel_size=3, padding=0, stride=1, groups=1,
+        self.intro = LipNorm(CircularConv2d(in_channels=img_channel, out_channels=width, kernel_size=3, padding=1, stride=1, groups=1,
                               bias=True))
-        self.ending = LipNorm(nn.Conv2d(in_channels=width, out_channels=img_channel, kernel_size=3, padding=0, stride=1, groups=1,
+        self.ending = LipNorm(CircularConv2d(in_channels=width, out_channels=img_channel, kernel_size=3, padding=1, stride=1, groups=1,
                               bias=True))
 
         self.encoders = nn.ModuleList()
@@ -194,12 +284,30 @@ class NAFNet_lr(nn.Module):
 
         self.padder_size = 2 ** len(self.encoders)
 
+        # NHWC lets cuDNN pick its channels_last kernels for the 1x1 / depthwise
+        # convs; LayerNorm2d, SimpleGate and CircularConv2d's padding keep the
+        # layout, the input is converted after check_image_size's F.pad
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
+        # e.g. 'bfloat16' / 'float16': run inference under autocast in that dtype
+        self.amp_dtype = getattr(torch, amp_dtype) if amp_dtype is not None else None
+
     def forward(self, inp):
+        # training always stays in full precision; leave any caller's autocast alone
+        if self.amp_dtype is None or self.training:
+            return self._forward(inp)
+        with torch.autocast(device_type=inp.device.type, dtype=self.amp_dtype):
+            return self._forward(inp)
+
+    def _forward(self, inp):
         B, C, H, W = inp.shape
         inp = self.check_image_size(inp)
+        if self.channels_last:
+            inp = inp.contiguous(memory_format=torch.channels_last)
 
-        x = self.CircularPadding(inp)
-        x = self.intro(x)
+        x = self.intro(inp)
 
         encs = []
 
@@ -215,12 +323,125 @@ class NAFNet_lr(nn.Module):
             x = x + enc_skip
             x = decoder(x)
 
-        x = self.CircularPadding(x)
         x = self.ending(x)
         x = x + inp
 
         return x[:, :, :H, :W]
 
+    def bake_lipnorm(self):
+        """Fold the LipNorm scaling into the conv weights for inference.
+
+        The parametrizations are removed and every conv keeps a plain
+        ``weight`` holding the scaled value, so the network no longer matches
+        LipNorm checkpoints nor keeps the constraint during training. Call it
+        after the weights are loaded, e.g. before TorchScript tracing.
+        """
+        modules = [m for m in self.modules()
+                   if parametrize.is_parametrized(m, 'weight')
+                   and any(isinstance(p, _LipNorm) for p in m.parametrizations.weight)]
+        for m in modules:
+            parametrize.remove_parametrizations(m, 'weight', leave_parametrized=True)
+        return self
+
+    def compile_for_inference(self, example_input):
+        """Trace a frozen TorchScript copy of the network for inference.
+
+        The copy has LipNorm baked into the conv weights and is specialized
+        to the shape of ``example_input``; the module itself is left
+        untouched, so it can still load checkpoints and be trained.
+        """
+        net = copy.deepcopy(self).eval().bake_lipnorm()
+        with torch.no_grad():
+            scripted = torch.jit.trace(net, example_input, check_trace=False)
+        scripted = torch.jit.freeze(scripted)
+        scripted = torch.jit.optimize_for_inference(scripted)
+        return scripted
+
+    def export_tensorrt(self, example_input, calib_dataloader=None, cache_file='./calibration.cache'):
+        """Compile the network with Torch-TensorRT for the shape of ``example_input``.
+
+        Without ``calib_dataloader`` the engine is built in FP16. With it,
+        INT8 is enabled as well and calibrated post-training on its batches.
+        Each batch must be the lq tensor alone (the network's single input):
+        the calibrator feeds every element of a list batch as a separate
+        input. The paired datasets here yield dicts, so build the loader
+        with e.g. ``collate_fn=lambda b: default_collate(b)['lq']``.
+        """
+        try:
+            import torch_tensorrt
+        except ImportError:
+            raise ImportError('Please install torch_tensorrt to enable TensorRT export.')
+
+        net = copy.deepcopy(self).eval().bake_lipnorm()
+        with torch.no_grad():
+            traced = torch.jit.trace(net, example_input, check_trace=False)
+
+        enabled_precisions = {torch.float, torch.half}
+        calibrator = None
+        if calib_dataloader is not None:
+            enabled_precisions.add(torch.int8)
+            calibrator = torch_tensorrt.ptq.DataLoaderCalibrator(
+                calib_dataloader,
+                cache_file=cache_file,
+                use_cache=False,
+                algo_type=torch_tensorrt.ptq.CalibrationAlgo.ENTROPY_CALIBRATION_2,
+                device=example_input.device)
+
+        return torch_tensorrt.compile(
+            traced,
+            ir='ts',
+            inputs=[torch_tensorrt.Input(tuple(example_input.shape), dtype=torch.float)],
+            enabled_precisions=enabled_precisions,
+            calibrator=calibrator)
+
+    def capture_cuda_graph(self, example_input, num_warmup=3):
+        """Capture the inference forward for a fixed input shape in a CUDA graph.
+
+        The graph is captured on a copy with LipNorm baked into the conv
+        weights, so the module itself (and its train / eval mode) is left
+        untouched and later weight updates are not seen by the graph. Returns
+        a callable that copies its input into a static buffer, replays the
+        graph and returns a copy of the output. Inputs must match the shape,
+        dtype and device of ``example_input``.
+        """
+        if not example_input.is_cuda:
+            raise ValueError(
+                "CUDA graph capture needs a CUDA input, got one on '{}'".format(example_input.device)
+            )
+
+        net = copy.deepcopy(self).eval().bake_lipnorm()
+        static_input = example_input.clone()
+
+        def step():
+            if net.amp_dtype is None:
+                return net._forward(static_input)
+            # autocast's cast cache is freed on exit while the graph would
+            # still read the cached low precision weights
+            with torch.autocast(device_type='cuda', dtype=net.amp_dtype, cache_enabled=False):
+                return net._forward(static_input)
+
+        # warm up on a side stream so lazy state (the local pooling kernel
+        # sizes, cuDNN autotuning) is settled before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(num_warmup):
+                step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(graph):
+            static_output = step()
+
+        def run(inp):
+            static_input.copy_(inp)
+            graph.replay()
+            return static_output.clone()
+
+        # the graph reads the copy's parameters directly, keep them alive
+        run.net = net
+        return run
+
     def check_image_size(self, x):
         _, _, h, w = x.size()
         mod_pad_h = (self.padder_size - h % self.padder_size) % self.padder_size
@@ -228,24 +449,6 @@ class NAFNet_lr(nn.Module):
         x = F.pad(x, (0, mod_pad_w, 0, mod_pad_h), 'circular')
         return x
 
-    def CircularPadding(self, inp):
-        _, _, H, W = inp.shape
-        kht, kwd = [3, 3]
-        sht, swd = [1, 1]
-        assert kwd%2 != 0 and kht%2 !=0 and (W-kwd)%swd==0 and (H-kht)%sht ==0, 'kernel_size should be odd, (dim-kernel_size) should be divisible by stride'
-
-        pwd = int((W - 1 - (W - kwd) / swd) // 2)
-        pht = int((H - 1 - (H - kht) / sht) // 2)
-        
-        # kht1, kwd1 = self.kernel_sizes[1]
-        # kht2, kwd2 = self.kernel_sizes[2]
-        # pwd = int((W - 1 - (W - kwd) / swd) // 2 + (W - 1 - (W - kwd1) / swd) // 2 + (W - 1 - (W - kwd2) / swd) // 2)
-        # pht = int((H - 1 - (H - kht) / sht) // 2 + (H - 1 - (H - kht1) / sht) // 2 + (H - 1 - (H - kht2) / sht) // 2)
-        
-        x = F.pad(inp, (pwd, pwd, pht, pht), 'circular')
-
-        return x
-
 
 class NAFNetLocal(Local_Base, NAFNet_lr):
     def __init__(self, *args, train_size=(1, 3, 256, 256), fast_imp=False, **kwargs):
@@ -255,10 +458,22 @@ class NAFNetLocal(Local_Base, NAFNet_lr):
         N, C, H, W = train_size
         base_size = (int(H * 1.5), int(W * 1.5))
 
+        # pads for train_size are fixed, compute them once instead of per forward
+        self._pad_hw = (H, W)
+        self._pad_h = (self.padder_size - H % self.padder_size) % self.padder_size
+        self._pad_w = (self.padder_size - W % self.padder_size) % self.padder_size
+
         self.eval()
         with torch.no_grad():
             self.convert(base_size=base_size, train_size=train_size, fast_imp=fast_imp)
 
+    def check_image_size(self, x):
+        if tuple(x.shape[-2:]) != self._pad_hw:
+            return NAFNet_lr.check_image_size(self, x)
+        if self._pad_h == 0 and self._pad_w == 0:
+            return x
+        return F.pad(x, (0, self._pad_w, 0, self._pad_h), 'circular')
+
 
 if __name__ == '__main__':
     import resource
@@ -306,8 +521,9 @@ if __name__ == '__main__':
 
     # exit(0)
 
-    # keras like model summary
-    summary(net, input_size=(img_channel, img_ht, img_wd), device='cpu')
+    # a torchsummary layer table would be incomplete: NAFBlock calls the
+    # norms and most 1x1 convs functionally, so their module hooks never fire
+    print('params', sum(p.numel() for p in net.parameters()))
 
     # inp_shape = (3, 512, 512)
 
@@ -72,10 +72,20 @@ class BaseModel():
         if self.opt['dist']:
             find_unused_parameters = self.opt.get('find_unused_parameters',
                                                   False)
+            # a static graph (no data-dependent control flow) lets DDP
+            # overlap allreduce with backward without re-checking unused
+            # parameters every iteration
+            static_graph = self.opt.get('static_graph', False)
+            gradient_as_bucket_view = self.opt.get('gradient_as_bucket_view',
+                                                   False)
+            bucket_cap_mb = self.opt.get('bucket_cap_mb', 25)
             net = DistributedDataParallel(
                 net,
                 device_ids=[torch.cuda.current_device()],
-                find_unused_parameters=find_unused_parameters)
+                find_unused_parameters=find_unused_parameters,
+                bucket_cap_mb=bucket_cap_mb,
+                gradient_as_bucket_view=gradient_as_bucket_view,
+                static_graph=static_graph)
         elif self.opt['num_gpu'] > 1:
             net = DataParallel(net)
         return net